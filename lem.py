@@ -6,6 +6,8 @@ import yaml
 import logging
 from datetime import datetime
 from functools import partial
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5 import QtGui, QtCore
 from PyQt5.QtWidgets import QTableWidgetItem, QHeaderView
@@ -22,6 +24,7 @@ sys.path.append('/usr/local/facet/tools/python/')
 sys.path.append('/usr/local/facet/tools/python/F2_live_model')
 from F2_live_model.bmad import BmadLiveModel
 from F2_pytools import slc_mags as slcmag
+from lem_alarms import shared_engine, LEM_ALARM_SUMMARY_PV
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 REPO_ROOT = os.path.join(*os.path.split(SELF_PATH)[:-1])
@@ -38,6 +41,15 @@ LEM_BASE = 'BMAD:SYS0:1:FACET2E:LEM'
 
 UPDATE_INTERVAL_MSEC = 1000
 
+# publish per-region alarm counts to LEM_ALARM_SUMMARY_PV on each refresh
+PUBLISH_ALARM_SUMMARY = False
+ALARM_ROW_COLOR = QtGui.QColor(120, 20, 20)
+
+# AIDA handles one SLC magnet set at a time, so only the EPICS parts of the
+# region units overlap, EPICS puts within a region are also issued together
+SLC_SET_LOCK = Lock()
+EPICS_PUT_TIMEOUT_SEC = 10.0
+
 
 class F2LEMApp(Display):
     def __init__(self, parent=None, args=None):
@@ -49,6 +61,15 @@ class F2LEMApp(Display):
         self.backup_profile = None
         self.backup_BDES = None
         self.last_LEM_file = None
+        self.trimmed_regions = []
+        self.alarm_summary = None
+        self.alarm_publish_ok = True
+
+        # the embedded lem_plots display reads its alarms from this engine
+        matching_quads = {reg: CONFIG['linac'][reg]['matching_quads'] for reg in self.regions}
+        self.alarms = shared_engine(self.regions, matching_quads)
+        self.alarms.owner = self
+        if PUBLISH_ALARM_SUMMARY: self.alarms.summary_pv = LEM_ALARM_SUMMARY_PV
 
         hdr = self.ui.LEM_table.horizontalHeader()
         for i in range(11):
@@ -85,13 +106,14 @@ class F2LEMApp(Display):
 
     def _refresh(self):
         try:
-            print(1)
             self._update_data()
-            print(2)
+            self._update_alarms()
             self._update_LEM_table()
         except Exception as E:
             self._status('ERROR: LEM data update failed')
             self._status(repr(E))
+            return
+        self._publish_alarm_summary()
 
     def _update_data(self):
         # fetches new LEM data, live twiss data (for live p(z)) and magnet BDESes
@@ -104,20 +126,41 @@ class F2LEMApp(Display):
         for i, dname in enumerate(self.LEM_data.device_name):
             self.BDES[i] = get_pv(f"{dname}:BDES").value
 
+    def _update_alarms(self):
+        # evaluate tolerance alarms once per refresh, log changes to the summary
+        self.alarms.evaluate(
+            self.LEM_data, self.BDES, self.LEM_ref_profile,
+            extant=self.ui.setScaleExtant.isChecked()
+            )
+        summary = self.alarms.summary_text()
+        if summary != self.alarm_summary:
+            self._status(f'LEM alarms: {summary}')
+            self.alarm_summary = summary
+
+    def _publish_alarm_summary(self):
+        # failures are only logged once until the next successful put
+        try:
+            self.alarms.publish_summary(ctx)
+            self.alarm_publish_ok = True
+        except Exception as E:
+            if self.alarm_publish_ok:
+                self._status('ERROR: alarm summary publish failed')
+                self._status(repr(E))
+            self.alarm_publish_ok = False
+
     def _update_LEM_table(self):
         # get LEM data from PVA service & other values from EPICS
         # make some calculations & pack data into relevant arrays
         tbl = self.ui.LEM_table
         tbl.clearContents()
         tbl.setRowCount(0)
+        alarm = self.alarms.alarm
         for reg in self.regions:
             qms = CONFIG['linac'][reg]['matching_quads']
             for i, elem in enumerate(self.LEM_data.element):
                 if (self.LEM_data.region[i] != reg): continue
                 dname = self.LEM_data.device_name[i]
 
-                self.BDES[i] = get_pv(f"{dname}:BDES").value
-
                 tbl.insertRow(i)
                 tbl.setItem(i, 0,  QTableWidgetItem(f'{reg}'))
                 tbl.setItem(i, 1,  QTableWidgetItem(f'{elem}'))
@@ -132,6 +175,9 @@ class F2LEMApp(Display):
                 tbl.setItem(i, 10,  QTableWidgetItem(f'{self.LEM_data.s[i]:.3f}'))
                 tbl.setItem(i, 11, QTableWidgetItem(f'{self.LEM_data.z[i]:.3f}'))
                 tbl.setItem(i, 12, QTableWidgetItem(f'{self.LEM_data.length[i]:.3f}'))
+                if alarm[i]:
+                    for j in range(tbl.columnCount()):
+                        if tbl.item(i, j): tbl.item(i, j).setBackground(ALARM_ROW_COLOR)
 
     def _trim(self):
         # trim magnets based on the current live momentum profile
@@ -145,96 +191,103 @@ class F2LEMApp(Display):
         # then set magnets & update the reference momentum profile
         self.last_LEM_file = self._write_LEM_data()
         self.backup_BDES = self.BDES
-        self.backup_profile = ctx.get(f'{LEM_BASE}:PROFILE')
+        self.backup_profile = np.array(ctx.get(f'{LEM_BASE}:PROFILE').value, dtype=np.float64)
         self._status(f'Saved previous settings to {self.last_LEM_file}')
 
-        SLC_dev, SLC_bdes, EPICS_dev, EPICS_bdes = self._get_trim_request()
-        self._magnet_set(EPICS_dev, EPICS_bdes, magtype='EPICS')
-        self._magnet_set(SLC_dev, SLC_bdes, magtype='SLC')
+        regions = [reg for reg in self.regions if self.enable_buttons[reg].isChecked()]
+        units = self._get_trim_request(regions)
+        self._run_trim_units(units)
 
-        self._publish_momentum_profile(live=True)
-        self.ui.ctrl_undo.setEnabled(True)
-        self._status('Done')
+        # only regions whose magnets were fully set get a new reference profile
+        self.trimmed_regions = [u.region for u in units if u.status == 'done']
+        if self.trimmed_regions:
+            self._publish_momentum_profile(live=True, regions=self.trimmed_regions)
+            self.ui.ctrl_undo.setEnabled(True)
+            self._status('Done')
+        else:
+            self.backup_BDES = None
+            self.ui.ctrl_undo.setEnabled(False)
+            self._status('ERROR: Trim failed in all regions, no magnets changed.')
 
     def _undo(self):
         # restores backup momentum profile & magnet settings
         self._status('Undoing trim operation ...')
 
-        SLC_dev, SLC_bdes, EPICS_dev, EPICS_bdes = self._get_trim_request(undo=True)
-        self._magnet_set(EPICS_dev, EPICS_bdes, magtype='EPICS')
-        self._magnet_set(SLC_dev, SLC_bdes, magtype='SLC')
-
-        self._publish_momentum_profile(live=False)
-        self.ui.ctrl_undo.setEnabled(False)
-        self.backup_BDES = None
-        self._status('Done')
-
-    def _get_trim_request(self, undo=False):
-        # get a list of magnets and BDESes to send to AIDA
-        SLC_dev, SLC_bdes = [], []
-        EPICS_dev, EPICS_bdes = [], []
-        for reg in self.regions:
-            if not self.enable_buttons[reg].isChecked(): continue
-            for i, device in enumerate(self.LEM_data.device_name):
-                if (self.LEM_data.region[i] != reg): continue
-                if device[:4] == 'QUAD':
-                    bdes_list = EPICS_bdes
-                    EPICS_dev.append(device)
-                else:
-                    bdes_list = SLC_bdes
-                    SLC_dev.append(device)
-                if undo:
-                    bdes_list.append(self.backup_BDES[i])
-                elif self.ui.setScaleDesign.isChecked():
-                    bdes_list.append(self.LEM_data.BLEM_DESIGN[i])
+        units = self._get_trim_request(self.trimmed_regions, undo=True)
+        self._run_trim_units(units)
+
+        # regions that failed to restore keep their trimmed settings & profile
+        restored = [u.region for u in units if u.status == 'done']
+        self.trimmed_regions = [u.region for u in units if u.status != 'done']
+        if not self.trimmed_regions:
+            self.ui.ctrl_undo.setEnabled(False)
+            self.backup_BDES = None
+        if restored:
+            self._publish_momentum_profile(live=False, regions=restored)
+            self._status('Done')
+        else:
+            self._status('ERROR: Undo failed in all regions, trim settings kept.')
+
+    def _get_trim_request(self, regions, undo=False):
+        # build one independent trim unit per region, each with its own backup
+        units = []
+        for reg in regions:
+            idx = [i for i, r in enumerate(self.LEM_data.region) if r == reg]
+            devices = [self.LEM_data.device_name[i] for i in idx]
+            if undo:
+                bdes = self.backup_BDES[idx]
+                backup = self.BDES[idx]
+            else:
+                if self.ui.setScaleDesign.isChecked():
+                    bdes = self.LEM_data.BLEM_DESIGN[idx]
                 elif self.ui.setScaleExtant.isChecked():
-                    bdes_list.append(self.LEM_data.BLEM_EXTANT[i])
-        return SLC_dev, SLC_bdes, EPICS_dev, EPICS_bdes
-
-    def _magnet_set(self, device_list, bdes_list, magtype='EPICS'):
-        # trim magnets to BLEM or to the backup_BDES
-        try:
-            self._status(f'Trimming {magtype} magnets ...')
-            print('magnet settings to input:')
-            for d,b in zip(device_list, bdes_list): print(f'  {d}: {b:.4f}')
-            if magtype == 'EPICS':
-                for dev, bdes in zip(device_list, bdes_list):
-                    get_pv(f'{dev}BDES').put(bdes)
-            elif magtype == 'SLC':
-                slcmag.set_magnets(device_list, bdes_list)
-            self._status('Done.')
-
-        except Exception as E:
-            self._status('ERROR: Trim operation failed.')
-            self._status(repr(E))
-
-
-    def _publish_momentum_profile(self, live=True, design=False):
+                    bdes = self.LEM_data.BLEM_EXTANT[idx]
+                backup = self.backup_BDES[idx]
+            units.append(RegionTrim(reg, devices, bdes, backup))
+        return units
+
+    def _run_trim_units(self, units):
+        # set all regions concurrently, each unit rolls itself back on failure
+        # blocks until every unit has finished, as the sequential trim did
+        self._status(f'Trimming {", ".join(u.region for u in units)} magnets ...')
+        if units:
+            with ThreadPoolExecutor(max_workers=len(units)) as pool:
+                list(pool.map(RegionTrim.apply, units))
+        for u in units:
+            self._status(f'{u.region}: {u.status}')
+            if u.error is not None: self._status(repr(u.error))
+            if u.rollback_error is not None:
+                self._status(f'ERROR: {u.region} rollback failed, restore from {self.last_LEM_file}')
+                self._status(repr(u.rollback_error))
+
+    def _publish_momentum_profile(self, live=True, design=False, regions=None):
         if live and design: raise ValueError('Invalid args')
         if live:
             msg = 'Publishing reference momentum ...'
-            prof = self._get_LEM_ref_profile()
+            prof = self._get_LEM_ref_profile(regions)
         elif design:
             msg = 'Setting reference momentum to design ...'
             prof = self.LEM_data.EREF
         else:
             msg = 'Resetting reference momentum ...'
-            prof = self.backup_profile
+            prof = self._merge_profile(self.backup_profile, regions)
 
         self._status(msg)
         r = ctx.put(f'{LEM_BASE}:PROFILE', NTNDArray().wrap(prof))
 
-    def _get_LEM_ref_profile(self):
+    def _get_LEM_ref_profile(self, regions=None):
         # get the energy profile at time of trim request
         # to be written to BMAD:SYS0:1:FACET2E:LEM:PROFILE
-
-        prof = np.ndarray(len(self.LEM_data.device_name))
-        for i, device in enumerate(self.LEM_data.device_name):
-            if not self.enable_buttons[self.LEM_data.region[i]].isChecked():
-                print(f'excluding not including {device} ...')
-                prof[i] =  self.LEM_ref_profile[i]
-            else:
-                prof[i] = self.LEM_data.EACT[i]
+        return self._merge_profile(self.LEM_data.EACT, regions)
+
+    def _merge_profile(self, prof_new, regions=None):
+        # take prof_new for the given regions (default: enabled regions)
+        # and the present reference profile everywhere else
+        if regions is None:
+            regions = [reg for reg in self.regions if self.enable_buttons[reg].isChecked()]
+        prof = np.array(self.LEM_ref_profile, dtype=np.float64)
+        for i, reg in enumerate(self.LEM_data.region):
+            if reg in regions: prof[i] = prof_new[i]
         return prof
 
     def _write_LEM_data(self):
@@ -269,3 +322,69 @@ class F2LEMApp(Display):
         print(txt_lines)
 
         return
+
+
+class RegionTrim:
+    """
+    trim unit for the LEM magnets in a single region
+    the unit either sets every magnet to bdes or restores all of them to backup
+    """
+    def __init__(self, region, devices, bdes, backup):
+        self.region = region
+        self.devices = devices
+        self.bdes = bdes
+        self.backup = backup
+        self.status = 'pending'
+        self.error = None
+        self.rollback_error = None
+
+    def apply(self):
+        try:
+            self._set(self.bdes)
+            self.status = 'done'
+        except Exception as E:
+            self.error = E
+            self.rollback()
+
+    def rollback(self):
+        try:
+            self._set(self.backup)
+            self.status = 'failed, rolled back'
+        except Exception as E:
+            self.rollback_error = E
+            self.status = 'failed, rollback failed'
+
+    def _set(self, bdes_list):
+        SLC_dev, SLC_bdes = [], []
+        EPICS_dev, EPICS_bdes = [], []
+        for device, bdes in zip(self.devices, bdes_list):
+            if device[:4] == 'QUAD':
+                EPICS_dev.append(device)
+                EPICS_bdes.append(bdes)
+            else:
+                SLC_dev.append(device)
+                SLC_bdes.append(bdes)
+        magnet_set(EPICS_dev, EPICS_bdes, magtype='EPICS')
+        magnet_set(SLC_dev, SLC_bdes, magtype='SLC')
+
+
+def magnet_set(device_list, bdes_list, magtype='EPICS'):
+    # trim magnets to BLEM or to the backup_BDES, raises on failure
+    if not device_list: return
+    print(f'{magtype} magnet settings to input:')
+    for d,b in zip(device_list, bdes_list): print(f'  {d}: {b:.4f}')
+    if magtype == 'EPICS':
+        # issue all puts, then wait for every one of them to complete
+        pvs = [get_pv(f'{dev}:BDES') for dev in device_list]
+        for pv, bdes in zip(pvs, bdes_list):
+            if pv.put(bdes, use_complete=True) is None:
+                raise RuntimeError(f'{pv.pvname} put failed, PV not connected')
+        t_end = time.time() + EPICS_PUT_TIMEOUT_SEC
+        while not all(pv.put_complete for pv in pvs):
+            if time.time() > t_end:
+                pending = [pv.pvname for pv in pvs if not pv.put_complete]
+                raise RuntimeError(f'put failed, no completion for {", ".join(pending)}')
+            time.sleep(0.01)
+    elif magtype == 'SLC':
+        with SLC_SET_LOCK:
+            slcmag.set_magnets(device_list, bdes_list)
@@ -0,0 +1,151 @@
+import numpy as np
+
+from p4p.nt import NTNDArray
+
+# BLEM-BDES & EERR tolerances (rel. %), DEFAULT_TOLERANCE_PCT unless overridden
+# per magnet type, i.e. {'QUAD': 3.0}, or per region, i.e. {'L3': {'QUAD': 3.0}}
+DEFAULT_TOLERANCE_PCT = 2.0
+MAGTYPE_TOLERANCE_PCT = {}
+REGION_TOLERANCE_PCT = {}
+EERR_TOLERANCE_PCT = 2.0
+
+# alarms clear only once the error falls this fraction below the tolerance
+HYSTERESIS_FRAC = 0.2
+
+LEM_ALARM_SUMMARY_PV = 'BMAD:SYS0:1:FACET2E:LEM:ALARM_SUMMARY'
+ALARM_SUMMARY_TIMEOUT_SEC = 0.2
+
+# matching quads & these regions are not trimmed to BLEM, so never BLEM alarms
+EXCLUDED_REGIONS = ['L0', 'L1']
+
+# one engine per GUI process, lem.py & its embedded lem_plots.py share it
+_SHARED_ENGINE = None
+
+
+def magnet_type(device_name):
+    # primary name of the device: QUAD:IN10:425 (EPICS) or LI11:QUAD:271 (SLC)
+    tokens = device_name.split(':')
+    if len(tokens) < 2: return device_name
+    return tokens[0] if tokens[0].isalpha() else tokens[1]
+
+
+def shared_engine(regions, matching_quads):
+    global _SHARED_ENGINE
+    if _SHARED_ENGINE is None: _SHARED_ENGINE = LEMAlarmEngine(regions, matching_quads)
+    return _SHARED_ENGINE
+
+
+class LEMAlarmEngine:
+    """
+    evaluates BDES-vs-BLEM and EACT-vs-reference tolerance alarms for all LEM
+    devices at once, with per-device alarm state latched between updates
+    consumers (table, plots, summary PV) read the results of evaluate()
+    rather than each recomputing the thresholds
+    only the display set as owner evaluates, others read LEM_data/BDES/errors
+    from the last evaluation
+    """
+    def __init__(self, regions, matching_quads, tol_magtype=None, tol_region=None,
+            tol_eerr=EERR_TOLERANCE_PCT, hysteresis=HYSTERESIS_FRAC, summary_pv=None):
+        # matching_quads: {region: [element names]}, excluded from BLEM alarms
+        self.regions = regions
+        self.matching_quads = matching_quads
+        self.tol_magtype = MAGTYPE_TOLERANCE_PCT if tol_magtype is None else tol_magtype
+        self.tol_region = REGION_TOLERANCE_PCT if tol_region is None else tol_region
+        self.tol_eerr = tol_eerr
+        self.hysteresis = hysteresis
+        self.summary_pv = summary_pv
+        self.owner = None
+
+        # inputs of the last evaluation
+        self.LEM_data = None
+        self.BDES = None
+        self.ref_profile = None
+        self.extant = None
+        self.device_names = None
+        self.excluded = None
+        self.tol_B = None
+        self.B_alarm = None
+        self.E_alarm = None
+        self.B_err = None
+        self.E_err = None
+        self.summary = {}
+
+    def _setup(self, device_names, regions, elements):
+        # (re)build per-device tolerance arrays whenever the device list changes
+        self.device_names = list(device_names)
+        region = np.array(regions)
+        self.excluded = np.array([
+            reg in EXCLUDED_REGIONS or elem in self.matching_quads.get(reg, [])
+            for reg, elem in zip(regions, elements)
+            ], dtype=bool)
+        mtypes = np.array([magnet_type(d) for d in self.device_names])
+        self.tol_B = np.full(len(self.device_names), DEFAULT_TOLERANCE_PCT, dtype=np.float64)
+        for mtype, tol in self.tol_magtype.items():
+            self.tol_B[mtypes == mtype] = tol
+        for reg, tols in self.tol_region.items():
+            for mtype, tol in tols.items():
+                self.tol_B[(region == reg) & (mtypes == mtype)] = tol
+        self.region_mask = {reg: region == reg for reg in self.regions}
+        self.B_alarm = np.zeros(len(self.device_names), dtype=bool)
+        self.E_alarm = np.zeros(len(self.device_names), dtype=bool)
+
+    def _latch(self, err, tol, state):
+        # set at |err| >= tol, clear only once |err| < (1-hysteresis)*tol
+        # BDES = 0 gives an infinite error & sets the alarm
+        # NaN errors (BLEM = BDES = 0) hold their previous state
+        abs_err = np.abs(err)
+        with np.errstate(invalid='ignore'):
+            set_ = abs_err >= tol
+            clear = abs_err < (1.0 - self.hysteresis) * tol
+        return set_ | (state & ~clear)
+
+    def evaluate(self, LEM_data, BDES, ref_profile, extant=True):
+        # LEM_data: value of the LEM:DATA PV, BDES & ref_profile: per-device arrays
+        if self.device_names is None or list(LEM_data.device_name) != self.device_names:
+            self._setup(LEM_data.device_name, LEM_data.region, LEM_data.element)
+
+        BDES = np.asarray(BDES, dtype=np.float64)
+        BLEM = LEM_data.BLEM_EXTANT if extant else LEM_data.BLEM_DESIGN
+        BLEM = np.asarray(BLEM, dtype=np.float64)
+        EACT = np.asarray(LEM_data.EACT, dtype=np.float64)
+        ref_profile = np.asarray(ref_profile, dtype=np.float64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.B_err = 100*(BLEM - BDES)/np.abs(BDES)
+            self.E_err = 100*(EACT - ref_profile)/EACT
+
+        # alarms latched against the other BLEM convention don't carry over
+        if extant != self.extant: self.B_alarm[:] = False
+
+        self.LEM_data, self.BDES, self.ref_profile = LEM_data, BDES, ref_profile
+        self.extant = extant
+        self.B_alarm = self._latch(self.B_err, self.tol_B, self.B_alarm) & ~self.excluded
+        self.E_alarm = self._latch(self.E_err, self.tol_eerr, self.E_alarm)
+        self._update_summary()
+        return self.B_alarm, self.E_alarm
+
+    @property
+    def alarm(self):
+        return self.B_alarm | self.E_alarm
+
+    def _update_summary(self):
+        # per-region count of devices in BLEM alarm & EERR alarm
+        self.summary = {}
+        for reg in self.regions:
+            m = self.region_mask[reg]
+            self.summary[reg] = (int(np.sum(self.B_alarm[m])), int(np.sum(self.E_alarm[m])))
+
+    def summary_array(self):
+        # compact summary: [L0 BLEM, L0 EERR, L1 BLEM, L1 EERR, ...]
+        return np.array([n for reg in self.regions for n in self.summary[reg]], dtype=np.int32)
+
+    def summary_text(self):
+        return ', '.join(f'{reg}: {nB} BLEM/{nE} EERR' for reg, (nB, nE) in self.summary.items())
+
+    def evaluates(self, display):
+        # True if display should evaluate, i.e. it owns the engine or nobody does
+        return self.owner is None or self.owner is display
+
+    def publish_summary(self, ctx, timeout=ALARM_SUMMARY_TIMEOUT_SEC):
+        if self.summary_pv is None: return
+        ctx.put(self.summary_pv, NTNDArray().wrap(self.summary_array()), timeout=timeout)
@@ -20,6 +20,7 @@ from pydm import Display
 sys.path.append('/usr/local/facet/tools/python/')
 sys.path.append('/usr/local/facet/tools/python/F2_live_model')
 from F2_live_model.bmad import BmadLiveModel
+from lem_alarms import shared_engine
 
 SELF_PATH = os.path.dirname(os.path.abspath(__file__))
 REPO_ROOT = os.path.join(*os.path.split(SELF_PATH)[:-1])
@@ -41,7 +42,6 @@ SPECTROMETER_BOUNDARIES = {
     }
 
 UPDATE_INTERVAL_MSEC = 200
-LEM_ERROR_TOELRANCE_PCT = 2.0
 
 class F2LEMPlots(Display):
     def __init__(self, extant=True, parent=None, args=None):
@@ -50,6 +50,8 @@ class F2LEMPlots(Display):
         self._startup_timer = QTimer.singleShot(10, self._startup)
         self.show_exc_err = True
         self.extant = extant
+        matching_quads = {reg: CONFIG['linac'][reg]['matching_quads'] for reg in self.regions}
+        self.alarms = shared_engine(self.regions, matching_quads)
 
     def ui_filename(self): return os.path.join(SELF_PATH, 'lem_plots.ui')
 
@@ -73,69 +75,46 @@ class F2LEMPlots(Display):
     def _update_LEM_data(self):
         # get LEM data from PVA service & other values from EPICS
         # make some calculations & pack data into relevant arrays
-        LEM_data = ctx.get(f'{LEM_BASE}:DATA').value
-        LEM_ref_profile = ctx.get(f'{LEM_BASE}:PROFILE').value
-        print(LEM_ref_profile)
         twiss_data = ctx.get('BMAD:SYS0:1:FACET2E:LIVE:TWISS').value
-
         self.pz_live = twiss_data.p0c
-        # self.E_err = 100 * (LEM_data.EACT - LEM_ref_profile) / LEM_data.EACT
-
-        self.E_err = 100 * (LEM_data.EACT - LEM_ref_profile) / LEM_data.EACT
 
-        self.BDESes = {}
-        self.BLEMs = {}
-        self.BLEMs_ext = {}
+        # when embedded in lem.py, reuse the data & alarms of its last refresh
+        # rather than fetching every BDES & evaluating a second time
+        if self.alarms.evaluates(self):
+            LEM_data = ctx.get(f'{LEM_BASE}:DATA').value
+            LEM_ref_profile = ctx.get(f'{LEM_BASE}:PROFILE').value
+            BDES = np.ndarray(len(LEM_data.device_name))
+            for i, dname in enumerate(LEM_data.device_name):
+                BDES[i] = get_pv(f'{dname}:BDES').value
+            self.alarms.evaluate(LEM_data, BDES, LEM_ref_profile, extant=self.extant)
+        LEM_data = self.alarms.LEM_data
+
+        # relative errors & alarms for all devices come from the engine,
+        # the per-region arrays below just index into them
+        # when embedded, BLEM errors follow lem.py's scaling convention
+        self.E_err = self.alarms.E_err
+        self.all_S = np.array(LEM_data.s)
+        region = np.array(LEM_data.region)
+        self.idx = {}
         self.S = {}
-        self.BLEM_err = {}
-        self.BLEM_ext_err = {}
-        # also track matching quads/other presently excluded devices
+        # also track matching quads/other presently excluded devices,
+        # always shown relative to BLEM_EXTANT
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exc_err = 100*(LEM_data.BLEM_EXTANT - self.alarms.BDES)/np.abs(self.alarms.BDES)
         self.exc_err = {}
         self.exc_S = {}
-        self.all_S = LEM_data.s
         for reg in self.regions:
-            self.BDESes[reg] = []
-            self.BLEMs[reg] = []
-            self.BLEMs_ext[reg] = []
-            self.BLEM_ext_err[reg] = {}
-            self.S[reg] = []
-            self.exc_S[reg] = []
-            self.exc_err[reg] = []
-            exc_blem = []
-            exc_bdes = []
-            qms = CONFIG['linac'][reg]['matching_quads']
-            
-            for i, elem in enumerate(LEM_data.element):
-                if (LEM_data.region[i] != reg): continue
-                dname = LEM_data.device_name[i]
-                # if not dname: continue
-
-                bdes = get_pv(f'{dname}:BDES').value
-                if elem in qms or reg in ['L0','L1']:
-                    self.exc_S[reg].append(LEM_data.s[i])
-                    exc_bdes.append(bdes)
-                    exc_blem.append(LEM_data.BLEM_EXTANT[i])
-                else:
-                    self.S[reg].append(LEM_data.s[i])
-                    self.BDESes[reg].append(bdes)
-                    self.BLEMs[reg].append(LEM_data.BLEM_DESIGN[i])
-                    self.BLEMs_ext[reg].append(LEM_data.BLEM_EXTANT[i])
-
-            self.all_S = np.array(self.all_S)
-            self.BLEMs[reg] =        np.array(self.BLEMs[reg], dtype=np.float64)
-            self.BLEMs_ext[reg] =    np.array(self.BLEMs_ext[reg], dtype=np.float64)
-            self.BDESes[reg] =       np.array(self.BDESes[reg], dtype=np.float64)
-            self.S[reg] =            np.array(self.S[reg], dtype=np.float64)
-            exc_blem, exc_bdes =     np.array(exc_blem), np.array(exc_bdes)
-            self.BLEM_err[reg] =     100*(self.BLEMs[reg] - self.BDESes[reg])/np.abs(self.BDESes[reg])
-            self.BLEM_ext_err[reg] = 100*(self.BLEMs_ext[reg] - self.BDESes[reg])/np.abs(self.BDESes[reg])
-            self.exc_err[reg] =      100*(exc_blem - exc_bdes)/np.abs(exc_bdes)
+            self.idx[reg] = np.flatnonzero((region == reg) & ~self.alarms.excluded)
+            exc_idx = np.flatnonzero((region == reg) & self.alarms.excluded)
+            self.S[reg] =       self.all_S[self.idx[reg]]
+            self.exc_S[reg] =   self.all_S[exc_idx]
+            self.exc_err[reg] = exc_err[exc_idx]
 
     def _update_LEM_plots(self):
         self.pzdat1.setData(self.f2m.S, self.pz_live)
 
-        i_OK_E = np.abs(self.E_err) < LEM_ERROR_TOELRANCE_PCT
-        i_bad_E = np.abs(self.E_err) >= LEM_ERROR_TOELRANCE_PCT
+        i_bad_E = self.alarms.E_alarm
+        i_OK_E = ~i_bad_E
         self.bg_E1.setOpts(
             x=self.all_S[i_OK_E], height=self.E_err[i_OK_E],
             width=2, brush='g', pen='g')
@@ -144,18 +123,16 @@ class F2LEMPlots(Display):
             width=2, brush='r', pen='r'
             )
 
-        if self.extant: errs = self.BLEM_ext_err
-        else: errs = self.BLEM_err
-
         for reg in self.regions:
-            i_OK_B = np.abs(errs[reg]) < LEM_ERROR_TOELRANCE_PCT 
-            i_bad_B = np.abs(errs[reg]) >= LEM_ERROR_TOELRANCE_PCT
+            errs = self.alarms.B_err[self.idx[reg]]
+            i_bad_B = self.alarms.B_alarm[self.idx[reg]]
+            i_OK_B = ~i_bad_B
             self.bg_items[reg][0].setOpts(
-                x=self.S[reg][i_OK_B], height=errs[reg][i_OK_B],
+                x=self.S[reg][i_OK_B], height=errs[i_OK_B],
                 brush='g', pen='g'
                 )
             self.bg_items[reg][1].setOpts(
-                x=self.S[reg][i_bad_B], height=errs[reg][i_bad_B],
+                x=self.S[reg][i_bad_B], height=errs[i_bad_B],
                 brush='r', pen='r'
                 )
             if self.show_exc_err:
@@ -0,0 +1,460 @@
+"""
+record & replay of the PV traffic seen by the LEM displays
+
+  python lem_replay.py capture LEM_traffic.lemrec --duration 600
+  python lem_replay.py replay LEM_traffic.lemrec --speed 1
+  python lem_replay.py replay LEM_traffic.lemrec --speed 0 --displays lem_plots
+
+capture subscribes to LEM:DATA, PROFILE, live TWISS, every LEM device BDES and
+the klystron ENLD/PDES/SBST PVs and appends each update to a binary log
+replay feeds that log to the displays in place of the live PV sources and
+reports frame time, CPU time & memory per refresh (--speed 0: no waiting)
+
+lem.py is timed through its 1 Hz data/alarm/table refresh; the displays
+embedded in lem.ui are hidden & their timers stopped, since pydm loads them as
+separate modules the replay store doesn't reach, and lem.ui's PyDM label
+widgets stay connected to their live channels
+replaying lem together with lem_plots has lem_plots read the alarm engine lem
+evaluates, as it does when embedded
+"""
+import os
+import sys
+import io
+import json
+import time
+import struct
+import resource
+import argparse
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+SELF_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(SELF_PATH)
+
+LEM_BASE = 'BMAD:SYS0:1:FACET2E:LEM'
+PVA_CHANNELS = [
+    f'{LEM_BASE}:DATA',
+    f'{LEM_BASE}:PROFILE',
+    'BMAD:SYS0:1:FACET2E:LIVE:TWISS',
+    ]
+
+# log format: magic, then records of <kind, t, pv index, payload length> + payload
+# pv names are written once (REC_NAME) & referred to by index afterwards
+# update payloads are a JSON tree of scalars & strings followed by np.save'd
+# arrays, arrays unchanged since the previous update of the PV are not repeated
+LOG_MAGIC = b'LEMREC2\n'
+REC_HEADER = struct.Struct('<BdHI')
+REC_NAME, REC_UPDATE, REC_SYNC = 0, 1, 2
+JSON_LEN = struct.Struct('<I')
+
+DISPLAYS = ['lem', 'lem_plots', 'klys_stat_plots']
+
+
+def _plain(V):
+    # reduce a p4p/pyepics value to nested dicts, numpy arrays & python scalars
+    if hasattr(V, 'todict'): V = V.todict()
+    if isinstance(V, dict): return {k: _plain(v) for k, v in V.items()}
+    if isinstance(V, (list, tuple)): V = np.array(V)
+    if isinstance(V, np.ndarray):
+        V = np.array(V)
+        return V.astype(str) if V.dtype == object else V
+    if isinstance(V, np.generic): return V.item()
+    return V
+
+
+def _encode(V, prev, arrays):
+    # JSON tree for a _plain value, arrays are appended to arrays & referenced
+    if isinstance(V, dict):
+        prev = prev if isinstance(prev, dict) else {}
+        return {k: _encode(v, prev.get(k), arrays) for k, v in V.items()}
+    if isinstance(V, np.ndarray):
+        if isinstance(prev, np.ndarray) and prev.dtype == V.dtype and np.array_equal(prev, V):
+            return {'__prev__': True}
+        arrays.append(V)
+        return {'__array__': len(arrays) - 1}
+    return V
+
+
+def _decode(T, prev, arrays):
+    if isinstance(T, dict):
+        if '__array__' in T: return arrays[T['__array__']]
+        if '__prev__' in T: return prev
+        prev = prev if isinstance(prev, dict) else {}
+        return {k: _decode(v, prev.get(k), arrays) for k, v in T.items()}
+    return T
+
+
+def encode_payload(V, prev=None):
+    arrays = []
+    tree = _encode(V, prev, arrays)
+    tree = json.dumps({'n': len(arrays), 'v': tree}).encode()
+    buf = io.BytesIO()
+    buf.write(JSON_LEN.pack(len(tree)))
+    buf.write(tree)
+    for A in arrays: np.save(buf, A, allow_pickle=False)
+    return buf.getvalue()
+
+
+def decode_payload(payload, prev=None):
+    n = JSON_LEN.unpack_from(payload)[0]
+    tree = json.loads(payload[JSON_LEN.size:JSON_LEN.size + n])
+    buf = io.BytesIO(payload[JSON_LEN.size + n:])
+    arrays = [np.load(buf, allow_pickle=False) for _ in range(tree['n'])]
+    return _decode(tree['v'], prev, arrays)
+
+
+def _attrs(V):
+    # inverse of _plain as far as the displays care: dicts -> attribute access
+    if isinstance(V, dict): return SimpleNamespace(**{k: _attrs(v) for k, v in V.items()})
+    return V
+
+
+class LEMRecorder:
+    """ thread-safe writer for timestamped PV updates """
+    def __init__(self, fname):
+        self.f = open(fname, 'wb')
+        self.f.write(LOG_MAGIC)
+        self.t0 = time.time()
+        self.pv_index = {}
+        self.prev = {}
+        self.n_updates = 0
+        self._lock = threading.Lock()
+
+    def _write(self, kind, t, idx, payload):
+        self.f.write(REC_HEADER.pack(kind, t, idx, len(payload)))
+        self.f.write(payload)
+
+    def record(self, pvname, value):
+        value = _plain(value)
+        with self._lock:
+            t = time.time() - self.t0
+            payload = encode_payload(value, self.prev.get(pvname))
+            self.prev[pvname] = value
+            if pvname not in self.pv_index:
+                self.pv_index[pvname] = len(self.pv_index)
+                self._write(REC_NAME, t, self.pv_index[pvname], pvname.encode())
+            self._write(REC_UPDATE, t, self.pv_index[pvname], payload)
+            self.n_updates += 1
+
+    def sync(self):
+        # marks the end of the initial snapshot of all PVs
+        with self._lock:
+            self._write(REC_SYNC, time.time() - self.t0, 0, b'')
+
+    def close(self):
+        with self._lock:
+            self.f.close()
+
+
+def read_log(fname):
+    # yields (kind, t, pvname, value) for every record in the log
+    names, prev = {}, {}
+    with open(fname, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError(f'{fname} is not a LEM PV traffic log')
+        while True:
+            hdr = f.read(REC_HEADER.size)
+            if len(hdr) < REC_HEADER.size: return
+            kind, t, idx, n = REC_HEADER.unpack(hdr)
+            payload = f.read(n)
+            if kind == REC_NAME:
+                names[idx] = payload.decode()
+            elif kind == REC_UPDATE:
+                prev[idx] = decode_payload(payload, prev.get(idx))
+                yield kind, t, names[idx], prev[idx]
+            elif kind == REC_SYNC:
+                yield kind, t, None, None
+
+
+def klystron_PVs():
+    from klys_stat_plots import ALL_KLYS, BAD_KLYS
+    pvs = []
+    for klys_channel in ALL_KLYS:
+        if klys_channel in BAD_KLYS: continue
+        s = int(klys_channel[2:4])
+        pvs += [f'{klys_channel}:ENLD', f'{klys_channel}:PDES', f'LI{s}:SBST:1:PDES']
+    return list(dict.fromkeys(pvs))
+
+
+def capture(fname, duration=None):
+    from p4p.client.thread import Context
+    from epics import get_pv
+
+    ctx = Context('pva')
+    rec = LEMRecorder(fname)
+
+    def _pva_update(pvname, V):
+        if isinstance(V, Exception): return
+        rec.record(pvname, V.value)
+
+    def _ca_update(pvname=None, value=None, **kw):
+        rec.record(pvname, value)
+
+    # initial snapshot, then subscribe to every channel the displays read
+    device_names = ctx.get(f'{LEM_BASE}:DATA').value.device_name
+    ca_channels = [f'{dname}:BDES' for dname in device_names] + klystron_PVs()
+    for pvname in PVA_CHANNELS:
+        rec.record(pvname, ctx.get(pvname).value)
+    ca_PVs = []
+    for pvname in ca_channels:
+        pv = get_pv(pvname)
+        rec.record(pvname, pv.get())
+        pv.add_callback(_ca_update)
+        ca_PVs.append(pv)
+    rec.sync()
+    subs = [ctx.monitor(pvname, lambda V, n=pvname: _pva_update(n, V)) for pvname in PVA_CHANNELS]
+
+    print(f'Recording {len(PVA_CHANNELS) + len(ca_channels)} PVs to {fname} ...')
+    try:
+        t_end = None if duration is None else time.time() + duration
+        while t_end is None or time.time() < t_end: time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for sub in subs: sub.close()
+        for pv in ca_PVs: pv.clear_callbacks()
+        rec.close()
+    print(f'Recorded {rec.n_updates} updates')
+
+
+class ReplayPV:
+    # stands in for an epics.PV, value & callbacks driven by the replay log
+    def __init__(self, pvname, value=None):
+        self.pvname = pvname
+        self.value = value
+        self.callbacks = {}
+
+    def get(self, **kw): return self.value
+
+    def put(self, value, **kw): return 1
+
+    def add_callback(self, callback, **kw):
+        idx = len(self.callbacks)
+        self.callbacks[idx] = callback
+        return idx
+
+    def clear_callbacks(self): self.callbacks = {}
+
+    def run_callbacks(self):
+        for cb in list(self.callbacks.values()):
+            cb(pvname=self.pvname, value=self.value)
+
+
+class ReplayStore:
+    """ latest replayed value of every PV, served through p4p/pyepics-like calls """
+    def __init__(self):
+        self.values = {}
+        self.PVs = {}
+
+    # p4p Context interface
+    def get(self, pvname):
+        return SimpleNamespace(value=self.values.get(pvname))
+
+    def put(self, pvname, value, **kw): return
+
+    # pyepics get_pv interface
+    def get_pv(self, pvname, **kw):
+        if pvname not in self.PVs:
+            self.PVs[pvname] = ReplayPV(pvname, self.values.get(pvname))
+        return self.PVs[pvname]
+
+    def update(self, pvname, value):
+        # returns the PV stand-in if a display subscribed to it
+        value = _attrs(value)
+        self.values[pvname] = value
+        pv = self.PVs.get(pvname)
+        if pv is None: return None
+        pv.value = value
+        return pv if pv.callbacks else None
+
+
+def _rss_MB():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class FrameStats:
+    def __init__(self, name):
+        self.name = name
+        self.wall, self.cpu, self.rss = [], [], []
+        self.n_late, self.n_err = 0, 0
+        self.first_err = None
+
+    def measure(self, func, app):
+        t, c = time.perf_counter(), time.process_time()
+        try:
+            func()
+        except Exception as E:
+            self.n_err += 1
+            if self.first_err is None: self.first_err = repr(E)
+        app.processEvents()
+        self.wall.append(time.perf_counter() - t)
+        self.cpu.append(time.process_time() - c)
+        self.rss.append(_rss_MB())
+
+    def report(self):
+        if not self.wall: return f'{self.name}: no frames'
+        wall, cpu = 1e3*np.array(self.wall), 1e3*np.array(self.cpu)
+        return (
+            f'{self.name}: {len(wall)} frames, '
+            f'frame time mean {wall.mean():.1f} / p95 {np.percentile(wall, 95):.1f} / max {wall.max():.1f} ms, '
+            f'CPU mean {cpu.mean():.1f} ms, RSS max {max(self.rss):.0f} MB, '
+            f'{self.n_late} late, {self.n_err} errors'
+            + (f' (first: {self.first_err})' if self.first_err else '')
+            )
+
+
+def _patch_sources(store, displays):
+    # route the module-level PV access of each display through the store
+    if 'lem' in displays:
+        import lem
+        lem.ctx, lem.get_pv = store, store.get_pv
+    if 'lem_plots' in displays:
+        import lem_plots
+        lem_plots.ctx, lem_plots.get_pv = store, store.get_pv
+    if 'klys_stat_plots' in displays:
+        import klys_stat_plots
+        klys_stat_plots.get_pv = store.get_pv
+
+
+def _freeze_embedded(display):
+    # hide embedded displays so pydm doesn't load them, stop any already loaded
+    from PyQt5.QtCore import QTimer
+    from pydm.widgets import PyDMEmbeddedDisplay
+    for w in display.findChildren(PyDMEmbeddedDisplay):
+        w.hide()
+        for timer in w.findChildren(QTimer): timer.stop()
+
+
+def _build_displays(displays, app):
+    # returns {name: (display, refresh function, refresh interval in sec)}
+    # refresh functions skip the displays' own exception handling so that
+    # errors show up in the frame stats
+    # lem is built first so it owns the shared alarm engine & refreshes first
+    built = {}
+    if 'lem' in displays:
+        import lem
+        d = lem.F2LEMApp()
+        _freeze_embedded(d)
+        def _refresh_lem(d=d):
+            d._update_data()
+            d._update_alarms()
+            d._update_LEM_table()
+            d._publish_alarm_summary()
+        built['lem'] = (d, _refresh_lem, lem.UPDATE_INTERVAL_MSEC/1000)
+    if 'lem_plots' in displays:
+        import lem_plots
+        d = lem_plots.F2LEMPlots()
+        def _refresh_lem_plots(d=d):
+            d._update_LEM_data()
+            d._update_LEM_plots()
+        built['lem_plots'] = (d, _refresh_lem_plots, lem_plots.UPDATE_INTERVAL_MSEC/1000)
+    if 'klys_stat_plots' in displays:
+        import klys_stat_plots
+        d = klys_stat_plots.F2KlysStatBarPlots()
+        built['klys_stat_plots'] = (d, None, None)
+
+    # frames are only painted (& rendering timed) for visible windows
+    for d, _, _ in built.values(): d.show()
+
+    # let delayed startups run, then take over the refresh timers
+    t_start = time.time()
+    while 'lem_plots' in built and not hasattr(built['lem_plots'][0], 'refresh_timer'):
+        app.processEvents()
+        if time.time() - t_start > 60: raise RuntimeError('lem_plots startup timed out')
+    # embedded displays that loaded anyway start their timers here, then get stopped
+    t_start = time.time()
+    while time.time() - t_start < 0.5: app.processEvents()
+    for d, _, _ in built.values():
+        if hasattr(d, 'refresh_timer'): d.refresh_timer.stop()
+    if 'lem' in built: _freeze_embedded(built['lem'][0])
+    app.processEvents()
+    return built
+
+
+def replay(fname, speed=1.0, displays=DISPLAYS):
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv)
+
+    store = ReplayStore()
+    _patch_sources(store, displays)
+
+    # apply the initial snapshot before the displays are built
+    log = read_log(fname)
+    t0 = 0.0
+    for kind, t, pvname, value in log:
+        if kind == REC_SYNC:
+            t0 = t
+            break
+        store.update(pvname, value)
+
+    built = _build_displays(displays, app)
+    stats = {name: FrameStats(name) for name in built}
+    next_due = {name: t0 for name, (_, f, _) in built.items() if f is not None}
+
+    wall_t0 = time.perf_counter()
+    def _log_time():
+        return t0 + speed*(time.perf_counter() - wall_t0)
+
+    def _wait_until(t_log):
+        if not speed: return
+        delay = (t_log - _log_time())/speed
+        if delay > 0: time.sleep(delay)
+
+    def _run_due(t_log):
+        # run every polled display frame due by log time t_log, each at its
+        # own due time, in order
+        while next_due and min(next_due.values()) <= t_log:
+            name = min(next_due, key=next_due.get)
+            _, refresh, interval = built[name]
+            _wait_until(next_due[name])
+            stats[name].measure(refresh, app)
+            next_due[name] += interval
+            # at realtime speed a frame is late if it ran past the next one
+            if speed and _log_time() > next_due[name]: stats[name].n_late += 1
+
+    t_last = t0
+    for kind, t, pvname, value in log:
+        if kind != REC_UPDATE: continue
+        _run_due(t)
+        _wait_until(t)
+        t_last = t
+        pv = store.update(pvname, value)
+        if pv is not None and 'klys_stat_plots' in stats:
+            stats['klys_stat_plots'].measure(pv.run_callbacks, app)
+    # frames due after the last record, up to the end of its refresh interval
+    if next_due: _run_due(t_last + max(built[name][2] for name in next_due))
+
+    print(f'Replayed {t_last - t0:.1f} s of {fname} in {time.perf_counter() - wall_t0:.1f} s')
+    for name in stats: print(f'  {stats[name].report()}')
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='record & replay LEM display PV traffic')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_cap = sub.add_parser('capture', help='record live PV updates to a log file')
+    p_cap.add_argument('fname')
+    p_cap.add_argument('--duration', type=float, default=None, help='seconds, default: until Ctrl-C')
+    p_rep = sub.add_parser('replay', help='feed a log file to the displays')
+    p_rep.add_argument('fname')
+    p_rep.add_argument('--speed', type=float, default=1.0, help='replay speed, 0: as fast as possible')
+    p_rep.add_argument('--displays', default=','.join(DISPLAYS), help='comma-separated list')
+    args = parser.parse_args()
+
+    if args.cmd == 'capture':
+        capture(args.fname, duration=args.duration)
+    elif args.cmd == 'replay':
+        displays = args.displays.split(',')
+        for d in displays:
+            if d not in DISPLAYS: parser.error(f'unknown display {d}')
+        replay(args.fname, speed=args.speed, displays=displays)
+
+
+if __name__ == '__main__':
+    main()